@@ -15,41 +15,152 @@ USAGE
     Configure user arguments in alerts.ini and meta.ini.
 '''
 
-import gzip
+import os
 import sys
+import signal
 import argparse
 import configparser
 import json
 import time
+import ctypes
 import multiprocessing as mp
+from collections import deque
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from requests.auth import HTTPBasicAuth
 from requests.adapters import HTTPAdapter
 import urllib3
+from urllib3.util.retry import Retry
 import pika
+import orjson
+import forward_fast
+
+# Use the Intel ISA-L zlib implementation when it's installed. It decompresses
+# much faster than the standard library's zlib module, with the same API.
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+# httpx is only needed when HTTP/2 is enabled in the .ini file
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 # Debug: uncomment the line below to support HTTP logging
 #   and uncomment add_stderr_logger in the new_process function
 #from urllib3 import add_stderr_logger
 
+# Messages are forwarded to Splunk in batches. A batch is posted once it holds
+# FLUSH_BYTES of event data, or once its oldest message has waited FLUSH_SECONDS.
+FLUSH_BYTES = 512 * 1024
+FLUSH_SECONDS = 1.0
+
+# How often each forwarder publishes its message counts to the main process
+PUBLISH_SECONDS = 1.0
+
+# How long a post to Splunk may stall before it fails, so a forwarder can exit
+POST_TIMEOUT_SECONDS = 30.0
+
+
+class Config(NamedTuple):
+    '''The .ini configuration variables, returned by get_config().'''
+
+    rabbitmq_user: str
+    rabbitmq_password: str
+    rabbitmq_server: str
+    rabbitmq_amqp_port: str
+    rabbitmq_http_port: str
+    rabbitmq_vhost: str
+    rabbitmq_exchange: str
+    rabbitmq_prefetch_count: int
+
+    splunk_url: str
+    splunk_token: str
+    splunk_raw_passthrough: bool
+    splunk_concurrent_posts: int
+    splunk_http2: bool
+
+    threads: int
+    pin_cpus: bool
+    cpu_offset: int
+    verbose: bool
+    debug: bool
+
 
 class RabbitToSplunk:
     '''The forwarder process - instantiated by main().'''
 
-    def __init__(self, config, process_num, result_queue):
+    def __init__(self, config, process_num, msg_counter, session_counter):
         '''Set the .ini configuration variables.'''
 
         self.config = config
         self.process_num = process_num
-        self.result_queue = result_queue
+        # Shared counters read by the main process. Only this process writes them.
+        self.msg_counter = msg_counter
+        self.session_counter = session_counter
         self.msg_count = 0
-        self.last_time = int(time.time())
-        self.verbose = config['verbose']
-        self.debug = config['debug']
+        self.session_count = 0
+        self.last_time = time.monotonic()
+        self.prefetch_count = config.rabbitmq_prefetch_count
+        self.concurrent_posts = max(1, config.splunk_concurrent_posts)
+        # Up to concurrent_posts batches are posted while the next one fills,
+        # and they all share the unacknowledged message window.
+        self.batch_limit = max(1, self.prefetch_count // (self.concurrent_posts + 1))
+        # The batches being posted to Splunk on the post threads, oldest
+        # first, as (future, delivery_tag, msg_count, session_count)
+        self.post_pool = ThreadPoolExecutor(max_workers=self.concurrent_posts)
+        self.posting = deque()
+        # Set on a post thread when a post fails, so no later posts start
+        self.post_failed = False
+        # Set by the SIGTERM handler to stop forwarding
+        self.stopping = False
+        # The batch of events waiting to be posted to Splunk
+        self.batch = bytearray()
+        self.batch_tag = None
+        self.batch_msg_count = 0
+        self.batch_session_count = 0
+        self.batch_start = time.monotonic()
+        self.verbose = config.verbose
+        self.debug = config.debug
+        self.raw_passthrough = config.splunk_raw_passthrough
+        self.splunk_url = config.splunk_url
         self.session = requests.Session()
-        self.session.mount('https://', HTTPAdapter())
-        self.session.mount('http://', HTTPAdapter())
-        print(f'Forwarding messages from {config["rabbitmq.exchange"]}.'
+        # Keep enough pooled connections to Splunk that posts reuse an open
+        # connection instead of paying for a new TCP/TLS handshake, and retry
+        # posts that fail while Splunk is temporarily unavailable.
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=max(16, config.threads * 2, self.concurrent_posts),
+                              pool_block=True,
+                              max_retries=Retry(total=3, backoff_factor=0.25,
+                                                status_forcelist=(502, 503, 504),
+                                                allowed_methods=frozenset(['POST'])))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        headers = {'Authorization': 'Splunk ' + config.splunk_token,
+                   'Content-Type': 'application/json'}
+        self.session.headers.update(headers)
+        self.http_errors = (requests.exceptions.RequestException,)
+
+        # With HTTP/2, concurrent posts are multiplexed over a single
+        # keep-alive connection to Splunk instead of one connection each.
+        self.http2 = None
+        if config.splunk_http2:
+            try:
+                if httpx is None:
+                    raise ImportError('No module named httpx')
+                # Raises ImportError if httpx was installed without the h2 package
+                self.http2 = httpx.Client(http2=True, headers=headers, verify=False,
+                                          timeout=httpx.Timeout(POST_TIMEOUT_SECONDS),
+                                          limits=httpx.Limits(max_connections=16,
+                                                              max_keepalive_connections=16))
+            except ImportError:
+                print('\n*** HTTP/2 requires the httpx library (pip3 install httpx[http2])...aborting.\n')
+                sys.exit(1)
+            self.http_errors = (httpx.HTTPError,)
+        print(f'Forwarding messages from {config.rabbitmq_exchange}.'
             f' Process_num = {process_num}')
 
     def start(self):
@@ -67,11 +178,11 @@ class RabbitToSplunk:
         # amqp://<user>:<password>@<server>:<port>/<vhost>
         connection_str = (
                         f'amqp://'
-                        f'{self.config["rabbitmq.user"]}:'
-                        f'{self.config["rabbitmq.password"]}@'
-                        f'{self.config["rabbitmq.server"]}:'
-                        f'{self.config["rabbitmq.amqp_port"]}/'
-                        f'{self.config["rabbitmq.vhost"]}'
+                        f'{self.config.rabbitmq_user}:'
+                        f'{self.config.rabbitmq_password}@'
+                        f'{self.config.rabbitmq_server}:'
+                        f'{self.config.rabbitmq_amqp_port}/'
+                        f'{self.config.rabbitmq_vhost}'
         )
         try:
             connection = pika.BlockingConnection(pika.URLParameters(connection_str))
@@ -80,7 +191,7 @@ class RabbitToSplunk:
             print(f'\n*** The RabbitMQ connection was refused: ({connection_str})...aborting.\n')
             sys.exit(1)
 
-        exchange = self.config['rabbitmq.exchange']
+        exchange = self.config.rabbitmq_exchange
 
         # Create the exchange to receive messages. This name must match the value in the SA ICDx UI.
         channel.exchange_declare(exchange=exchange, durable=True)
@@ -101,37 +212,202 @@ class RabbitToSplunk:
         # keep up. It's better to let the messages stay queued in RabbitMQ, where
         # it will be obvious on the RabbitMQ GUI that the consumer isn't keeping
         # up.
-        channel.basic_qos(prefetch_count=10)
+        #
+        # A batch is flushed no later than when it holds its share of
+        # prefetch_count messages, since RabbitMQ won't deliver more than
+        # prefetch_count until the batches being posted and the batch being
+        # filled are acknowledged.
+        channel.basic_qos(prefetch_count=self.prefetch_count, global_qos=False)
+
+        # Finish and acknowledge the current batches when asked to stop
+        signal.signal(signal.SIGTERM, self.graceful_stop)
 
         # Start consuming messages
-        channel.basic_consume(queue=queue, on_message_callback=self.rabbit_callback, auto_ack=False)
+        self.consume(channel, queue)
+        connection.close()
 
-        channel.start_consuming()
+    def graceful_stop(self, signum, frame):
+        '''
+        SIGTERM handler. The consume loop does the actual stop, since pika
+            can't be called from inside a signal handler.
+        '''
 
+        self.stopping = True
 
-    def add_event(self, json_data):
+    def consume(self, channel, queue):
         '''
-        Convert each element to a JSON string and add the required "event" tags
-            for the HEC data (time, host, source, event).
+        Pull messages from the queue and forward them to Splunk in batches.
+            Batches are posted on separate threads, several at a time, while
+            the next batch is decompressed and converted. Every message in a
+            batch is acknowledged with a single ack once the batch and all
+            batches before it have been posted.
+            If anything fails before then, the unacknowledged messages are
+            returned to the queue.
         '''
 
-        event = {'event': json_data}
-        if 'device_time' in json_data.keys():
-            # Time must be in seconds.milliseconds. Device time has milliseconds.microseconds
-            event['time'] = int(json_data['device_time'])/1000
-        if 'device_name' in json_data.keys():
-            event['host'] = json_data['device_name']
-        if 'product_name' in json_data.keys():
-            event['source'] = json_data['product_name']
+        try:
+            # The inactivity timeout wakes the loop up when no messages arrive,
+            # so a partial batch is still flushed after FLUSH_SECONDS.
+            for method, properties, body in channel.consume(queue, inactivity_timeout=0.25):
+                if method is not None:
+                    self.add_to_batch(method, properties, body)
+                else:
+                    # Keep the main process up to date while the queue is idle
+                    self.publish_counts()
+
+                # Acknowledge posted batches as soon as Splunk has accepted them.
+                # A multiple ack covers every earlier message, so batches are
+                # acknowledged in the order they were received.
+                while self.posting and self.posting[0][0].done():
+                    self.finish_post(channel)
+
+                if self.batch_msg_count and (
+                        len(self.batch) >= FLUSH_BYTES
+                        or self.batch_msg_count >= self.batch_limit
+                        or time.monotonic() - self.batch_start >= FLUSH_SECONDS
+                        or self.stopping):
+                    self.flush_batch(channel)
+
+                if self.stopping:
+                    # Post and acknowledge everything received so far, then
+                    # return any messages buffered by pika to the queue.
+                    while self.posting:
+                        self.finish_post(channel)
+                    channel.cancel()
+                    self.publish_counts(force=True)
+                    break
+        except KeyboardInterrupt:
+            # Let the batches being posted finish and acknowledge them, so only
+            # the messages that haven't been posted are redelivered.
+            try:
+                while self.posting and channel.is_open:
+                    self.finish_post(channel)
+            finally:
+                self.requeue_unacked(channel)
+            raise
+        except BaseException:
+            self.requeue_unacked(channel)
+            raise
+
+    def requeue_unacked(self, channel):
+        '''Return every unacknowledged message to the queue.'''
+
+        # Stop the post threads from starting any more posts, so messages
+        # returned to the queue aren't also delivered to Splunk. Posts that
+        # are already running can't be stopped. (Cancelling the futures
+        # directly does what shutdown(cancel_futures=True) does on 3.9+.)
+        for (future, delivery_tag, msg_count, session_count) in self.posting:
+            future.cancel()
+        self.post_pool.shutdown(wait=False)
+
+        # The newest unacknowledged message is in the batch being filled,
+        # or else in the newest batch being posted.
+        if self.batch_tag is not None:
+            unacked_tag = self.batch_tag
+        elif self.posting:
+            unacked_tag = self.posting[-1][1]
+        else:
+            return
+
+        if channel.is_open:
+            channel.basic_nack(delivery_tag=unacked_tag, multiple=True, requeue=True)
+
+    def add_to_batch(self, method, properties, body):
+        '''Convert a RabbitMQ message to HEC events and append them to the batch.'''
+
+        (event_data, session_count) = self.format_events(properties.content_encoding, body)
+
+        if self.batch_msg_count == 0:
+            self.batch_start = time.monotonic()
+        self.batch += event_data
+        self.batch_tag = method.delivery_tag
+        self.batch_msg_count += 1
+        self.batch_session_count += session_count
+
+    def flush_batch(self, channel):
+        '''Start posting the batch to Splunk on a post thread.'''
+
+        # Wait for the oldest post if the maximum number are already running
+        if len(self.posting) >= self.concurrent_posts:
+            self.finish_post(channel)
 
-        event_str = json.dumps(event)
+        future = self.post_pool.submit(self.post_batch, bytes(self.batch))
+        self.posting.append((future, self.batch_tag, self.batch_msg_count, self.batch_session_count))
 
-        return event_str
+        self.batch = bytearray()
+        self.batch_tag = None
+        self.batch_msg_count = 0
+        self.batch_session_count = 0
 
+    def post_batch(self, event_data):
+        '''Post a batch on a post thread, unless an earlier post has failed.'''
 
-    def send_to_splunk(self, content_encoding, body):
+        if self.post_failed:
+            # This batch will be returned to the queue with the failed one
+            raise RuntimeError('An earlier post to Splunk failed')
+        try:
+            self.send_to_splunk(event_data)
+        except BaseException:
+            self.post_failed = True
+            raise
+
+    def finish_post(self, channel):
+        '''Wait for the oldest batch being posted, then acknowledge all of its messages.'''
+
+        (future, delivery_tag, msg_count, session_count) = self.posting[0]
+        # Re-raises any error from the post thread
+        future.result()
+        # Acknowledge every message up to and including the last one in the batch
+        channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        self.posting.popleft()
+        self.msg_count += msg_count
+        self.session_count += session_count
+
+        self.publish_counts()
+
+    def publish_counts(self, force=False):
+        '''Periodically copy the message counts to the main process for aggregation.'''
+
+        now = time.monotonic()
+        if force or now - self.last_time >= PUBLISH_SECONDS:
+            self.msg_counter.value = self.msg_count
+            self.session_counter.value = self.session_count
+            self.last_time = now
+
+
+    def decompress(self, body):
+        '''Decompress a gzipped message.'''
+
+        # wbits=31 expects a gzip header and trailer. A decompressor object
+        # skips the Python-level header parsing done by gzip.decompress().
+        decompressor = zlib.decompressobj(wbits=31)
+        raw = decompressor.decompress(body)
+        self.check_complete(decompressor)
+
+        # A decompressor object stops at the end of the first gzip member.
+        # Keep going if several compressed members were concatenated. Like
+        # gzip.decompress(), accept zero bytes of padding after a member.
+        rest = decompressor.unused_data.lstrip(b'\0')
+        if rest:
+            members = [raw]
+            while rest:
+                decompressor = zlib.decompressobj(wbits=31)
+                members.append(decompressor.decompress(rest))
+                self.check_complete(decompressor)
+                rest = decompressor.unused_data.lstrip(b'\0')
+            raw = b''.join(members)
+
+        return raw
+
+    def check_complete(self, decompressor):
+        '''Fail like gzip.decompress() does if a gzip member was truncated.'''
+
+        if not decompressor.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+    def format_events(self, content_encoding, body):
         '''
-        Post the message to Splunk
+        Convert a RabbitMQ message to Splunk HEC events.
 
         Splunk requires event data to be wrapped in an "event" element.
         It also allows multiple events in a single message. When receiving
@@ -145,80 +421,111 @@ class RabbitToSplunk:
         # Data from Security Analytics is gzipped, so it needs to be decompressed
         if content_encoding == 'gzip':
             # Unzip the data
-            json_str = gzip.decompress(body)
-            json_str = json_str.decode('utf-8')
+            raw = self.decompress(body)
         else:
             # Data isn't compressed
-            json_str = body.decode('utf-8')
+            raw = body
 
 
         if self.debug:
-            print(f'\nSending data: {json_str}')
+            # Only print the start of the data, messages may be several MB
+            print(f'\nSending data: {raw[:512].decode("utf-8", errors="replace")}')
+
+        # Check for a JSON list without copying the whole message
+        if self.raw_passthrough and not raw[:64].lstrip().startswith(b'['):
+            # A single event can be forwarded without parsing and re-encoding
+            # it. The HEC time, host, and source tags aren't extracted.
+            return (b'{"event":' + raw + b'}', 1)
 
-        json_data = json.loads(json_str)
+        # orjson parses the bytes directly, without decoding them to a str first
+        try:
+            json_data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN, Infinity, and numbers too large for a double,
+            # which the standard json module accepts
+            json_data = json.loads(raw)
         if not isinstance(json_data, list):
             # Convert to a list to allow for common wrapping code
             json_data = [json_data]
 
-        # Wrap the data in an "event" key
-        event_list = map(self.add_event, json_data)
-        # Join all the data into a single message. There is no separator
-        event_data = "".join(event_list)
+        # Wrap each item in an "event" key and join them into a single message
+        try:
+            event_data = forward_fast.wrap_batch(json_data)
+        except orjson.JSONEncodeError:
+            # orjson can't encode strings with lone surrogates (such as "\ud800")
+            # or integers wider than 64 bits, which the json module parsed
+            event_data = forward_fast.wrap_batch_json(json_data)
+
+        # Return the events and the number of sessions
+        return (event_data, len(json_data))
+
+    def send_to_splunk(self, event_data):
+        '''Post a batch of HEC events to Splunk.'''
 
         try:
-            reply = self.session.post(self.config['splunk.url'],
-                verify = False, data=event_data,
-                headers = {'Authorization': 'Splunk '
-                + self.config['splunk.token']})
-            reply.raise_for_status()
-        except requests.exceptions.RequestException as error:
+            if self.http2 is not None:
+                reply = self.http2.post(self.splunk_url, content=event_data)
+                status_code = reply.status_code
+                reason = reply.reason_phrase
+            else:
+                # Closing the reply returns its connection to the pool
+                with self.session.post(self.splunk_url,
+                        verify = False, data=event_data,
+                        timeout=POST_TIMEOUT_SECONDS) as reply:
+                    status_code = reply.status_code
+                    reason = reply.reason
+        except self.http_errors as error:
             print(f'\n*** Splunk connectivity error...aborting ***\n {error}\n')
             sys.exit(1)
 
-        if not reply.ok:
-            print(f'\n*** Failure: {reply.reason} ({reply.status_code})...aborting.\n')
+        if status_code >= 300:
+            print(f'\n*** Failure: {reason} ({status_code})...aborting.\n')
             sys.exit(1)
 
         if self.verbose:
+            # One progress dot per batch posted
             print('.', end='', flush=True)
 
-        # Return the number of sessions
-        return len(json_data)
-
-    def rabbit_callback(self, channel, method, properties, body):
-        '''Callback for new messages from RabbitMQ.'''
-
-        # Send to splunk
-        session_count = self.send_to_splunk(properties.content_encoding, body)
-        # Acknowledge that the message has been handled
-        channel.basic_ack(delivery_tag = method.delivery_tag)
-        # Publish the message count to the main process for aggregation
-        self.result_queue.put((self.process_num, session_count))
-
 
 def get_config(config_file):
         # Grab the parameters from the config file
         config = configparser.ConfigParser()
-        config_data = {}
-        if len(config.read(config_file)) == 1:
-            config_data['rabbitmq.user'] = config.get('rabbitmq', 'user')
-            config_data['rabbitmq.password'] = config.get('rabbitmq', 'password')
-            config_data['rabbitmq.server'] = config.get('rabbitmq', 'server')
-            config_data['rabbitmq.amqp_port'] = config.get('rabbitmq', 'amqp_port')
-            config_data['rabbitmq.http_port'] = config.get('rabbitmq', 'http_port')
-            config_data['rabbitmq.vhost'] = config.get('rabbitmq', 'vhost')
-            config_data['rabbitmq.exchange'] = config.get('rabbitmq', 'exchange')
-
-            config_data['splunk.url'] = config.get('splunk','url')
-            config_data['splunk.token'] = config.get('splunk','token')
-
-            config_data['threads'] = config.getint('general', 'threads')
-            config_data['verbose'] = config.getboolean('general', 'verbose')
-            config_data['debug'] = config.getboolean('general', 'debug')
-        else:
+        if len(config.read(config_file)) != 1:
             print(f'\n*** Unable to open configuration file \'{config_file}\'.')
             sys.exit(1)
 
+        config_data = Config(
+            rabbitmq_user = config.get('rabbitmq', 'user'),
+            rabbitmq_password = config.get('rabbitmq', 'password'),
+            rabbitmq_server = config.get('rabbitmq', 'server'),
+            rabbitmq_amqp_port = config.get('rabbitmq', 'amqp_port'),
+            rabbitmq_http_port = config.get('rabbitmq', 'http_port'),
+            rabbitmq_vhost = config.get('rabbitmq', 'vhost'),
+            rabbitmq_exchange = config.get('rabbitmq', 'exchange'),
+            rabbitmq_prefetch_count = config.getint('rabbitmq', 'prefetch_count', fallback=200),
+
+            splunk_url = config.get('splunk','url'),
+            splunk_token = config.get('splunk','token'),
+            splunk_raw_passthrough = config.getboolean('splunk', 'raw_passthrough', fallback=False),
+            splunk_concurrent_posts = config.getint('splunk', 'concurrent_posts', fallback=4),
+            splunk_http2 = config.getboolean('splunk', 'http2', fallback=False),
+
+            threads = config.getint('general', 'threads'),
+            pin_cpus = config.getboolean('general', 'pin_cpus', fallback=False),
+            cpu_offset = config.getint('general', 'cpu_offset', fallback=0),
+            verbose = config.getboolean('general', 'verbose'),
+            debug = config.getboolean('general', 'debug'),
+        )
+
+        # Each thread's prefetch window is shared by its concurrent posts and
+        # the batch being filled, so it must hold at least one message each.
+        # (A prefetch_count of 0, unlimited in RabbitMQ, isn't supported.)
+        min_prefetch_count = max(1, config_data.splunk_concurrent_posts) + 1
+        if config_data.rabbitmq_prefetch_count < min_prefetch_count:
+            print(f'\n*** prefetch_count must be at least concurrent_posts + 1 '
+                  f'({min_prefetch_count}) in \'{config_file}\'.')
+            sys.exit(1)
+
         return config_data
 
 def add_vhost(config):
@@ -228,16 +535,16 @@ def add_vhost(config):
     #   -XPUT http://localhost:15672/api/vhosts/dx
     url = (
         f'http://'
-        f'{config["rabbitmq.server"]}:'
-        f'{config["rabbitmq.http_port"]}/api/vhosts/'
-        f'{config["rabbitmq.vhost"]}'
+        f'{config.rabbitmq_server}:'
+        f'{config.rabbitmq_http_port}/api/vhosts/'
+        f'{config.rabbitmq_vhost}'
     )
 
     # Verify RabbitMQ connectivity while configuring the virtual host.
     try:
         reply = requests.put(url, verify = False,
-                        auth = HTTPBasicAuth(config['rabbitmq.user'],
-                        config['rabbitmq.password']))
+                        auth = HTTPBasicAuth(config.rabbitmq_user,
+                        config.rabbitmq_password))
     except Exception as error:
         print(f'\n*** The connection was refused to RabbitMQ ({url})...aborting. Error: ${error}\n')
         sys.exit(1)
@@ -253,8 +560,8 @@ def test_splunk_connection(config):
     # Disable the warning about connecting without verifying SSL
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    url=config['splunk.url']
-    headers = {"Authorization": "Splunk " + config['splunk.token']}
+    url=config.splunk_url
+    headers = {"Authorization": "Splunk " + config.splunk_token}
     json_health_check = {"event": "Splunk connectivity check"}
     try:
         reply = requests.post(url, headers=headers, json=json_health_check, verify=False)
@@ -274,15 +581,25 @@ def test_splunk_connection(config):
         print(f'{error}\n')
         sys.exit(1)
 
-def new_process(config, process_num, result_queue):
+def new_process(config, process_num, msg_counter, session_counter):
     '''Parse the configuration file and start RabbitToSplunk() forwarding.'''
     # Python doesn't support true multi-threading due to the GIL. The way to
     # work around this limitation is to create multiple processes. This method
     # will create a new process that will run independently of the main
     # process, other than sending back results for reporting.
+
+    # Optionally pin each process to its own CPU, starting at cpu_offset, so
+    # the forwarders don't migrate between cores (Linux only).
+    if config.pin_cpus and hasattr(os, 'sched_setaffinity'):
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[(config.cpu_offset + process_num) % len(cpus)]})
+        except OSError as error:
+            print(f'*** Unable to pin process {process_num} to a CPU: {error}', file=sys.stderr)
+
     try:
         # Begin forwarding
-        forwarder = RabbitToSplunk(config, process_num, result_queue)
+        forwarder = RabbitToSplunk(config, process_num, msg_counter, session_counter)
         forwarder.start()
     except KeyboardInterrupt:
         print('Interrupted. Exiting child python process.', file=sys.stderr)
@@ -308,47 +625,65 @@ def main():
     # Make sure we can connect to splunk
     test_splunk_connection(config)
 
-    # Create the requested number of processes
-    result_queue = mp.Queue()
-    process_list = map(lambda process_num:
-                       mp.Process(target=new_process,
-                       args=(config, process_num, result_queue)),
-                       range(config['threads']))
+    # Create the requested number of processes. Forking lets the children
+    # inherit the configuration instead of unpickling their own copy.
+    ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+    # Each process reports its totals through its own pair of shared
+    # counters, so reporting needs no queue or lock.
+    msg_counters = [ctx.Value(ctypes.c_uint64, 0, lock=False)
+                    for process_num in range(config.threads)]
+    session_counters = [ctx.Value(ctypes.c_uint64, 0, lock=False)
+                        for process_num in range(config.threads)]
+    process_list = [ctx.Process(target=new_process,
+                                args=(config, process_num,
+                                      msg_counters[process_num],
+                                      session_counters[process_num]))
+                    for process_num in range(config.threads)]
     try:
         print('Waiting for messages. To exit press CTRL+C', file=sys.stderr)
         # Start the processes
         for p in process_list:
             p.start()
 
+        # Treat SIGTERM like CTRL+C, so the child processes are stopped too.
+        # This is set after the children start so they don't inherit it.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
         # Counters for periodic status
-        total_msg_count = 0
+        exchange_name = config.rabbitmq_exchange
         last_total_msg_count = 0
-        total_session_count = 0
         last_total_session_count = 0
-        last_time = int(time.time())
+        last_time = time.monotonic()
 
         while True:
-            # Wait for a result from one of the child processes
-            (process_num, session_count) = result_queue.get()
-            total_msg_count += 1
-            total_session_count += session_count
+            # Sample the counters published by the child processes
+            time.sleep(5)
+            total_msg_count = sum(counter.value for counter in msg_counters)
+            total_session_count = sum(counter.value for counter in session_counters)
 
-            now = int(time.time())
+            now = time.monotonic()
             delta_time = now - last_time
-            if delta_time >= 5:
+            if total_msg_count != last_total_msg_count:
                 msg_per_second = (total_msg_count - last_total_msg_count) / delta_time
                 sessions_per_second = (total_session_count - last_total_session_count) / delta_time
-                print(f'\n[python] Exchange: {config["rabbitmq.exchange"]}, Total Messages: {total_msg_count}, '
+                print(f'\n[python] Exchange: {exchange_name}, Total Messages: {total_msg_count}, '
                       f'Messages/Second: {msg_per_second:,.1f}, '
                       f'Sessions/Second: {int(sessions_per_second)}')
-                last_time = now
-                last_total_msg_count = total_msg_count
-                last_total_session_count = total_session_count
+            last_time = now
+            last_total_msg_count = total_msg_count
+            last_total_session_count = total_session_count
     except KeyboardInterrupt:
         print('Interrupted', file=sys.stderr)
-        for p in process_list:
-            p.kill()
-            p.join()
+        # Ask the children to stop, giving them a chance to post and
+        # acknowledge their current batches before they're killed.
+        running = [p for p in process_list if p.is_alive()]
+        for p in running:
+            p.terminate()
+        for p in running:
+            p.join(5.0)
+            if p.is_alive():
+                p.kill()
+                p.join()
         sys.exit(1)
 
 
@@ -0,0 +1,119 @@
+'''
+forward_fast.py
+
+The per-record Splunk HEC wrapping used by consumer.py. It runs once for
+every forwarded record, so it's kept in its own type-annotated module that
+may optionally be compiled with mypyc for faster forwarding:
+
+    cd python
+    mypyc forward_fast.py
+
+consumer.py imports the compiled extension when it's present, and this
+source file otherwise.
+'''
+
+import json
+from typing import Any, Callable, Dict, List
+
+import orjson
+
+# The fields add_event() copies into the HEC time, host, and source tags
+HEC_FIELDS = ('device_time', 'device_name', 'product_name')
+
+
+def add_event(json_data: Dict[str, Any]) -> bytes:
+    '''
+    Convert each element to encoded JSON and add the required "event" tags
+        for the HEC data (time, host, source, event).
+    '''
+
+    return orjson.dumps(hec_event(json_data))
+
+
+def hec_event(json_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''Wrap an element in an "event" tag and add its time, host, and source tags.'''
+
+    device_time = json_data.get('device_time')
+    device_name = json_data.get('device_name')
+    product_name = json_data.get('product_name')
+
+    event: Dict[str, Any] = {'event': json_data}
+    if device_time is not None:
+        # Time must be in seconds.milliseconds. Device time has milliseconds.microseconds
+        event['time'] = int(device_time)/1000
+    if device_name is not None:
+        event['host'] = device_name
+    if product_name is not None:
+        event['source'] = product_name
+
+    return event
+
+
+def wrap_event(json_data: Any) -> bytes:
+    '''Wrap a record that has no HEC tags to extract.'''
+
+    # A record that does have HEC tags doesn't match the message's schema
+    if isinstance(json_data, dict) and (
+            'device_time' in json_data or 'device_name' in json_data
+            or 'product_name' in json_data):
+        return add_event(json_data)
+
+    return orjson.dumps({'event': json_data})
+
+
+def wrap_full(json_data: Dict[str, Any]) -> bytes:
+    '''Wrap a record that has all of the HEC tags.'''
+
+    device_time = json_data.get('device_time')
+    device_name = json_data.get('device_name')
+    product_name = json_data.get('product_name')
+
+    # A record with a missing or null HEC tag doesn't match the message's schema
+    if device_time is None or device_name is None or product_name is None:
+        return add_event(json_data)
+
+    # Time must be in seconds.milliseconds. Device time has milliseconds.microseconds
+    return orjson.dumps({'event': json_data,
+                         'time': int(device_time)/1000,
+                         'host': device_name,
+                         'source': product_name})
+
+
+def select_wrapper(first: Any) -> Callable[[Any], bytes]:
+    '''
+    Choose the wrapper for a message. The records in a message usually
+        share a schema, so the first record decides which wrapper is tried
+        first. Records that don't match it are wrapped by add_event().
+    '''
+
+    if isinstance(first, dict):
+        if not any(field in first for field in HEC_FIELDS):
+            return wrap_event
+        if all(first.get(field) is not None for field in HEC_FIELDS):
+            return wrap_full
+    return add_event
+
+
+def wrap_batch(json_data: List[Any]) -> bytes:
+    '''
+    Wrap every record of a message in an "event" key and join them into a
+        single message. Splunk accepts one event per line.
+    '''
+
+    if not json_data:
+        return b""
+
+    wrap = select_wrapper(json_data[0])
+    return b"\n".join([wrap(record) for record in json_data])
+
+
+def wrap_batch_json(json_data: List[Any]) -> bytes:
+    '''
+    Like wrap_batch(), but encode with the standard json module. This is
+        slower, but handles the strings with lone surrogates and integers
+        wider than 64 bits that orjson can't encode.
+    '''
+
+    return b"\n".join([json.dumps(hec_event(record) if isinstance(record, dict)
+                                   else {'event': record}).encode('utf-8')
+                        for record in json_data])